@@ -16,11 +16,9 @@ LOG = logging.getLogger()
 def _exec(cmd, cwd=None):
     sys.stderr.write('\n----- Exec: %s -----\n' % cmd)
     out, err = processutils.execute(cmd, cwd=cwd, shell=True)
-    for line in out.split('\n'):
-        sys.stderr.write('out: %s\n' % line)
+    sys.stderr.writelines('out: %s\n' % line for line in out.split('\n'))
     sys.stderr.write('\n')
-    for line in err.split('\n'):
-        sys.stderr.write('err: %s\n' % line)
+    sys.stderr.writelines('err: %s\n' % line for line in err.split('\n'))
     sys.stderr.write('\n----- End: %s -----\n' % cmd)
     return out, err
 
@@ -1,6 +1,16 @@
 CONFIG_FILE = 'config_file'
 IMAGE_LAYER = 'image_layer'
 
+# Layer files handed to output writers are opened with a read buffer this
+# large. tarfile and the writers copy in chunks of 16 - 100 KiB, which with
+# the default 8 KiB buffer means a read syscall for every one of them.
+LAYER_READ_BUFFER_SIZE = 1024 * 1024
+
+# tarfile copies member data through a 16 KiB buffer by default. Layers are
+# mostly large files, so copy them in bigger chunks when extracting or
+# writing tarballs, and when writers copy whole layer files to disk.
+TAR_COPY_BUFFER_SIZE = 2 * 1024 * 1024
+
 RUNC_SPEC_TEMPLATE = """{
     "ociVersion": "1.0.2-dev",
     "process": {
@@ -3,15 +3,93 @@
 # Call me like this:
 #  docker-image-extract tarfile.tar extracted
 
+import mmap
 import tarfile
 import json
 import os
+import shutil
 import sys
 
+# Standalone script, so this mirrors occystrap.constants.TAR_COPY_BUFFER_SIZE.
+COPY_BUFFER_SIZE = 2 * 1024 * 1024
+
+
+def copy_range(src_fd, dst_fd, offset, size):
+    # Copy size bytes starting at offset in src_fd to the current position of
+    # dst_fd without the data passing through userspace. Returns False if the
+    # kernel can't do that for these files, in which case the caller needs to
+    # copy the data itself.
+    copied = 0
+    try:
+        while copied < size:
+            count = os.copy_file_range(src_fd, dst_fd, size - copied,
+                                       offset + copied)
+            if count == 0:
+                return False
+            copied += count
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+def is_within(path, root):
+    return os.path.commonpath([root, path]) == root
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def remove_lower_layers(path, keep):
+    # Remove everything below path except for what the current layer has
+    # already written, which is listed in keep.
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        if child not in keep:
+            remove_path(child)
+        elif os.path.isdir(child) and not os.path.islink(child):
+            remove_lower_layers(child, keep)
+
+
+def create_file(path):
+    # Create a new file at path, in one system call for the usual case where
+    # nothing is there yet. An existing entry is replaced rather than
+    # truncated, so that we never write through a symlink or into other hard
+    # links to an older version of the file.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        fd = os.open(path, flags, 0o666)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, flags, 0o666)
+    except FileExistsError:
+        print('  --> remove old version of file')
+        os.unlink(path)
+        fd = os.open(path, flags, 0o666)
+    return open(fd, 'wb')
+
+
+class MappedFile(mmap.mmap):
+    # tarfile checks that its file object is seekable, but mmap objects only
+    # grew a seekable() method in Python 3.13.
+    def seekable(self):
+        return True
+
+
 image_path = sys.argv[1]
-extracted_path = sys.argv[2]
+extracted_path = os.path.abspath(sys.argv[2])
+real_extracted_path = os.path.realpath(extracted_path)
 
-with tarfile.open(image_path) as image:
+# The image tarball is mapped into memory rather than read through a file
+# object. Walking each layer means many small reads of member headers at
+# scattered offsets, and with a mapping those are memory copies instead of a
+# seek and read system call each.
+with open(image_path, 'rb') as image_file, \
+        MappedFile(image_file.fileno(), 0, access=mmap.ACCESS_READ) as image_map, \
+        tarfile.open(fileobj=image_map, copybufsize=COPY_BUFFER_SIZE) as image:
     manifest = json.loads(image.extractfile('manifest.json').read())
     print('Manifest: %s' % manifest)
 
@@ -20,7 +98,22 @@ with tarfile.open(image_path) as image:
 
     for layer in manifest[0]['Layers']:
         print('Found layer: %s' % layer)
-        layer_tar = tarfile.open(fileobj=image.extractfile(layer))
+        layer_member = image.getmember(layer)
+        layer_file = image.extractfile(layer_member)
+        layer_tar = tarfile.open(fileobj=layer_file,
+                                 copybufsize=COPY_BUFFER_SIZE)
+
+        # If neither the image tarball nor the layer is compressed then the
+        # contents of the layer's files sit unmodified in the image file, and
+        # can be copied straight from there. Otherwise the offsets tarfile
+        # gives us are into a decompressed stream, not the file on disk.
+        uncompressed = (image.fileobj is image_map and
+                        layer_tar.fileobj is layer_file)
+
+        # Paths written by this layer, and their parent directories. Opaque
+        # whiteouts only hide the contents of lower layers, so these must
+        # survive one.
+        written = set()
 
         for tarinfo in layer_tar:
             print('  ... %s' % tarinfo.name)
@@ -28,9 +121,70 @@ with tarfile.open(image_path) as image:
                 print('  --> skip device files')
                 continue
 
-            dest = os.path.join(extracted_path, tarinfo.name)
-            if not tarinfo.isdir() and os.path.exists(dest):
-                print('  --> remove old version of file')
-                os.unlink(dest)
+            dest = os.path.normpath(os.path.join(extracted_path, tarinfo.name))
+            if dest == extracted_path or not is_within(dest, extracted_path):
+                print('  --> skip member outside of extraction directory')
+                continue
+            dirname, filename = os.path.split(dest)
+
+            # A lower layer might have made part of the path a symlink which
+            # points elsewhere, so check where the member would really land
+            # before writing or deleting anything for it.
+            if not is_within(os.path.realpath(dirname), real_extracted_path):
+                print('  --> skip member outside of extraction directory')
+                continue
+
+            # Whiteouts delete things from lower layers, and are handled
+            # here without extracting the (empty) marker file itself. Some
+            # light reading on how this works...
+            # https://github.com/opencontainers/image-spec/blob/main/layer.md#whiteouts
+            if filename.startswith('.wh.'):
+                if filename[4:] in ('', '.', '..'):
+                    print('  --> skip whiteout outside of extraction directory')
+                    continue
+
+                if filename == '.wh..wh..opq':
+                    print('  --> opaque directory, remove lower layer contents')
+                    if os.path.isdir(dirname):
+                        remove_lower_layers(dirname, written)
+                else:
+                    print('  --> whiteout, remove %s' % filename[4:])
+                    remove_path(os.path.join(dirname, filename[4:]))
+                continue
+
+            path = dest
+            while path not in written and path != extracted_path:
+                written.add(path)
+                path = os.path.dirname(path)
+
+            if not tarinfo.isreg():
+                # Replace whatever a lower layer left here, except for a real
+                # directory when this member is a directory too. A symlink is
+                # always replaced, as extract() would follow it.
+                if (os.path.islink(dest) or
+                        (not tarinfo.isdir() and os.path.lexists(dest))):
+                    print('  --> remove old version of file')
+                    os.unlink(dest)
+                layer_tar.extract(tarinfo, path=extracted_path)
+                continue
+
+            # Regular files are the bulk of most layers, so write them
+            # directly instead of paying for extract()'s per member setup.
+            with create_file(dest) as f:
+                if not (uncompressed and not tarinfo.issparse() and
+                        copy_range(image_file.fileno(), f.fileno(),
+                                   layer_member.offset_data + tarinfo.offset_data,
+                                   tarinfo.size)):
+                    f.seek(0)
+                    f.truncate()
+                    shutil.copyfileobj(layer_tar.extractfile(tarinfo), f,
+                                       COPY_BUFFER_SIZE)
 
-            layer_tar.extract(tarinfo, path=extracted_path)
+            # Ownership, permissions and timestamps are applied the same way
+            # extract() would, including treating failures as non-fatal.
+            try:
+                layer_tar.chown(tarinfo, dest, False)
+                layer_tar.chmod(tarinfo, dest)
+                layer_tar.utime(tarinfo, dest)
+            except tarfile.ExtractError as e:
+                print('  --> %s' % e)
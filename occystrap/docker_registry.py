@@ -8,6 +8,7 @@
 # https://github.com/opencontainers/image-spec/blob/main/media-types.md documents
 # the new OCI mime types.
 
+import concurrent.futures
 import hashlib
 import io
 import logging
@@ -15,6 +16,7 @@ import os
 import re
 import sys
 import tempfile
+import threading
 import zlib
 
 from occystrap import constants
@@ -25,14 +27,40 @@ LOG.setLevel(logging.INFO)
 
 DELETED_FILE_RE = re.compile(r'.*/\.wh\.(.*)$')
 
+# Layers larger than this are fetched with parallel range requests, if the
+# caller has asked for more than one range per layer.
+RANGE_FETCH_THRESHOLD = 32 * 1024 * 1024
 
-def always_fetch():
+# Decompressed layers smaller than this are kept in memory instead of being
+# written to a temporary file.
+SPOOL_LAYER_THRESHOLD = 8 * 1024 * 1024
+
+# Layer downloads are read, hashed and decompressed in chunks of this size.
+# Larger chunks mean fewer trips through the Python loop and let hashlib
+# and zlib work on long buffers.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# How many layers beyond the number being downloaded may be waiting to be
+# handed to the caller. Each one holds a decompressed layer, in memory or in
+# a temporary file, until the caller has processed it.
+DOWNLOAD_LOOKAHEAD = 1
+
+
+def always_fetch(digest):
     return True
 
 
+class RangeRequestsUnsupportedException(Exception):
+    pass
+
+
+class DownloadCancelledException(Exception):
+    pass
+
+
 class Image(object):
     def __init__(self, registry, image, tag, os='linux', architecture='amd64', variant='',
-                 secure=True):
+                 secure=True, max_concurrent_downloads=3, max_parallel_ranges=1):
         self.registry = registry
         self.image = image
         self.tag = tag
@@ -40,9 +68,24 @@ class Image(object):
         self.architecture = architecture
         self.variant = variant
         self.secure = secure
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.max_parallel_ranges = max_parallel_ranges
 
         self._cached_auth = None
 
+        # Every request we make is below this prefix, so only format it once.
+        moniker = 'https'
+        if not self.secure:
+            moniker = 'http'
+        self._url_prefix = ('%s://%s/v2/%s'
+                            % (moniker, self.registry, self.image))
+
+    def _manifest_url(self, reference):
+        return '%s/manifests/%s' % (self._url_prefix, reference)
+
+    def _blob_url(self, digest):
+        return '%s/blobs/%s' % (self._url_prefix, digest)
+
     def request_url(self, method, url, headers=None, data=None, stream=False):
         if not headers:
             headers = {}
@@ -69,19 +112,8 @@ class Image(object):
 
     def fetch(self, fetch_callback=always_fetch):
         LOG.info('Fetching manifest')
-        moniker = 'https'
-        if not self.secure:
-            moniker = 'http'
-
         r = self.request_url(
-            'GET',
-            '%(moniker)s://%(registry)s/v2/%(image)s/manifests/%(tag)s'
-            % {
-                'moniker': moniker,
-                'registry': self.registry,
-                'image': self.image,
-                'tag': self.tag
-            },
+            'GET', self._manifest_url(self.tag),
             headers={'Accept': ('application/vnd.docker.distribution.manifest.v2+json,'
                                 'application/vnd.docker.distribution.manifest.list.v2+json')})
 
@@ -106,14 +138,7 @@ class Image(object):
                         m['platform'].get('variant', '') == self.variant):
                     LOG.info('Fetching matching manifest')
                     r = self.request_url(
-                        'GET',
-                        '%(moniker)s://%(registry)s/v2/%(image)s/manifests/%(tag)s'
-                        % {
-                            'moniker': moniker,
-                            'registry': self.registry,
-                            'image': self.image,
-                            'tag': m['digest']
-                        },
+                        'GET', self._manifest_url(m['digest']),
                         headers={'Accept': ('application/vnd.docker.distribution.manifest.v2+json, '
                                             'application/vnd.oci.image.manifest.v1+json')})
                     manifest = r.json()
@@ -126,73 +151,215 @@ class Image(object):
             raise Exception('Unknown manifest content type %s!' %
                             r.headers['Content-Type'])
 
-        LOG.info('Fetching config file')
-        r = self.request_url(
-            'GET',
-            '%(moniker)s://%(registry)s/v2/%(image)s/blobs/%(config)s'
-            % {
-                'moniker': moniker,
-                'registry': self.registry,
-                'image': self.image,
-                'config': config_digest
-            })
-        config = r.content
-        h = hashlib.sha256()
-        h.update(config)
-        if h.hexdigest() != config_digest.split(':')[1]:
-            LOG.error('Hash verification failed for image config blob (%s vs %s)'
-                      % (config_digest.split(':')[1], h.hexdigest()))
-            sys.exit(1)
+        LOG.info('There are %d image layers' % len(manifest['layers']))
 
-        config_filename = ('%s.json' % config_digest.split(':')[1])
-        yield (constants.CONFIG_FILE, config_filename,
-               io.BytesIO(config))
+        # Layers are downloaded by a small pool of workers so that network
+        # transfers overlap with each other and with whatever the caller is
+        # doing with the config and layers we have already yielded, which is
+        # why the downloads are started before we even fetch the config. We
+        # still yield the layers in manifest order, as the output writers
+        # depend on that. Manifests can reference the same blob more than
+        # once (empty layers are the common case), so each unique digest is
+        # only downloaded once and the download is kept until its last
+        # reference has been yielded.
+        #
+        # Finished downloads hold a decompressed layer each, so only a window
+        # of them is started at a time. A new download is only started once
+        # an earlier one has been handed over and released.
+        #
+        # If we stop early, because of an error or because the caller stopped
+        # asking for layers, the downloads still running are told to give up
+        # so that we don't wait for transfers nobody will use.
+        window = self.max_concurrent_downloads + DOWNLOAD_LOOKAHEAD
+        cancelled = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrent_downloads) as executor:
+            wanted = []
+            layers_by_digest = {}
+            references = {}
+            for layer in manifest['layers']:
+                layer_filename = layer['digest'].split(':')[1]
+                wanted.append(fetch_callback(layer_filename))
+                if not wanted[-1]:
+                    continue
+
+                layers_by_digest.setdefault(layer_filename, layer)
+                references.setdefault(layer_filename, 0)
+                references[layer_filename] += 1
+
+            # Downloads which have been started and not yet released, by
+            # digest. Digests are started in the order of their first use.
+            downloads = {}
+            queued = iter(list(layers_by_digest))
+
+            def start_downloads(limit):
+                while len(downloads) < limit:
+                    digest = next(queued, None)
+                    if not digest:
+                        return
+                    downloads[digest] = executor.submit(
+                        self._fetch_layer, layers_by_digest[digest], cancelled)
 
-        LOG.info('There are %d image layers' % len(manifest['layers']))
-        for layer in manifest['layers']:
-            layer_filename = layer['digest'].split(':')[1]
-            if not fetch_callback(layer_filename):
-                LOG.info('Fetch callback says skip layer %s' % layer['digest'])
-                yield (constants.IMAGE_LAYER, layer_filename, None)
-                continue
-
-            LOG.info('Fetching layer %s (%d bytes)'
-                     % (layer['digest'], layer['size']))
-            r = self.request_url(
-                'GET',
-                '%(moniker)s://%(registry)s/v2/%(image)s/blobs/%(layer)s'
-                % {
-                    'moniker': moniker,
-                    'registry': self.registry,
-                    'image': self.image,
-                    'layer': layer['digest']
-                },
-                stream=True)
-
-            # We can use zlib for streaming decompression, but we need to tell it
-            # to ignore the gzip header which it doesn't understand. Unfortunately
-            # tarfile doesn't do streaming writes (and we need to know the
-            # decompressed size before we can write to the tarfile), so we stream
-            # to a temporary file on disk.
             try:
+                start_downloads(window)
+
+                LOG.info('Fetching config file')
+                r = self.request_url('GET', self._blob_url(config_digest))
+                config = r.content
                 h = hashlib.sha256()
-                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                h.update(config)
+                if h.hexdigest() != config_digest.split(':')[1]:
+                    LOG.error('Hash verification failed for image config blob (%s vs %s)'
+                              % (config_digest.split(':')[1], h.hexdigest()))
+                    sys.exit(1)
 
-                with tempfile.NamedTemporaryFile(delete=False) as tf:
-                    LOG.info('Temporary file for layer is %s' % tf.name)
-                    for chunk in r.iter_content(8192):
-                        tf.write(d.decompress(chunk))
-                        h.update(chunk)
+                config_filename = ('%s.json' % config_digest.split(':')[1])
+                yield (constants.CONFIG_FILE, config_filename,
+                       io.BytesIO(config))
 
-                if h.hexdigest() != layer_filename:
-                    LOG.error('Hash verification failed for layer (%s vs %s)'
-                              % (layer_filename, h.hexdigest()))
-                    sys.exit(1)
+                for layer, fetch in zip(manifest['layers'], wanted):
+                    layer_filename = layer['digest'].split(':')[1]
+                    if not fetch:
+                        LOG.info('Fetch callback says skip layer %s' % layer['digest'])
+                        yield (constants.IMAGE_LAYER, layer_filename, None)
+                        continue
+
+                    # Layers kept for a later reference can fill the window,
+                    # so make sure the one we need now has been started.
+                    while layer_filename not in downloads:
+                        start_downloads(len(downloads) + 1)
+
+                    layer_file, layer_hash = downloads[layer_filename].result()
+                    references[layer_filename] -= 1
+                    try:
+                        if layer_hash != layer_filename:
+                            LOG.error('Hash verification failed for layer (%s vs %s)'
+                                      % (layer_filename, layer_hash))
+                            sys.exit(1)
 
-                with open(tf.name, 'rb') as f:
-                    yield (constants.IMAGE_LAYER, layer_filename, f)
+                        layer_file.seek(0)
+                        yield (constants.IMAGE_LAYER, layer_filename, layer_file)
+
+                    finally:
+                        if references[layer_filename] == 0:
+                            del downloads[layer_filename]
+                            layer_file.close()
+
+                    start_downloads(window)
 
             finally:
-                os.unlink(tf.name)
+                # If we are exiting early, then stop the downloads which are
+                # still running and release the ones we were never asked for.
+                cancelled.set()
+                for download in downloads.values():
+                    download.cancel()
+
+                for download in downloads.values():
+                    if download.cancelled():
+                        continue
+                    try:
+                        layer_file, _ = download.result()
+                        layer_file.close()
+                    except Exception:
+                        pass
 
         LOG.info('Done')
+
+    def _fetch_layer(self, layer, cancelled):
+        LOG.info('Fetching layer %s (%d bytes)'
+                 % (layer['digest'], layer['size']))
+
+        # We can use zlib for streaming decompression, but we need to tell it
+        # to ignore the gzip header which it doesn't understand. Unfortunately
+        # tarfile doesn't do streaming writes (and we need to know the
+        # decompressed size before we can write to the tarfile), so we stream
+        # to a temporary file. Many layers are tiny, so that file stays in
+        # memory until it grows past SPOOL_LAYER_THRESHOLD. After that it is
+        # anonymous (O_TMPFILE on Linux), so it needs no cleanup beyond being
+        # closed and can't be left behind if we crash.
+        h = hashlib.sha256()
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        tf = tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_LAYER_THRESHOLD,
+            buffering=constants.LAYER_READ_BUFFER_SIZE)
+        try:
+            for chunk in self._layer_chunks(layer, cancelled):
+                tf.write(d.decompress(chunk))
+                h.update(chunk)
+        except Exception:
+            tf.close()
+            raise
+
+        return tf, h.hexdigest()
+
+    def _layer_chunks(self, layer, cancelled):
+        url = self._blob_url(layer['digest'])
+
+        # A single TCP stream often can't fill the pipe for a large layer, so
+        # optionally split it into ranges which are fetched in parallel into
+        # a scratch file. The chunks are then replayed in order so that the
+        # hash and decompression see exactly what a single GET would have.
+        if (self.max_parallel_ranges > 1 and
+                layer['size'] > RANGE_FETCH_THRESHOLD):
+            with tempfile.TemporaryFile() as blob:
+                try:
+                    self._fetch_ranges(url, layer['size'], blob, cancelled)
+                    blob.seek(0)
+                    d = blob.read(DOWNLOAD_CHUNK_SIZE)
+                    while d:
+                        yield d
+                        d = blob.read(DOWNLOAD_CHUNK_SIZE)
+                    return
+
+                except RangeRequestsUnsupportedException:
+                    LOG.info('Registry does not support range requests, '
+                             'falling back to a single request for %s'
+                             % layer['digest'])
+
+        r = self.request_url('GET', url, stream=True)
+        try:
+            for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                if cancelled.is_set():
+                    raise DownloadCancelledException(url)
+                yield chunk
+        finally:
+            r.close()
+
+    def _fetch_ranges(self, url, size, blob, cancelled):
+        range_size = -(-size // self.max_parallel_ranges)
+        LOG.info('Fetching %s as %d ranges of up to %d bytes'
+                 % (url, self.max_parallel_ranges, range_size))
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_parallel_ranges) as executor:
+            ranges = []
+            for start in range(0, size, range_size):
+                end = min(start + range_size, size) - 1
+                ranges.append(executor.submit(
+                    self._fetch_range, url, blob, start, end, cancelled))
+
+            for r in ranges:
+                r.result()
+
+    def _fetch_range(self, url, blob, start, end, cancelled):
+        r = self.request_url(
+            'GET', url, headers={'Range': 'bytes=%d-%d' % (start, end)},
+            stream=True)
+        if r.status_code != 206:
+            r.close()
+            raise RangeRequestsUnsupportedException(url)
+
+        offset = start
+        try:
+            for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                if cancelled.is_set():
+                    raise DownloadCancelledException(url)
+                os.pwrite(blob.fileno(), chunk, offset)
+                offset += len(chunk)
+        finally:
+            r.close()
+
+        if offset != end + 1:
+            raise Exception('Short read for bytes %d-%d of %s (got %d bytes)'
+                            % (start, end, url, offset - start))
@@ -10,6 +10,7 @@ from occystrap import output_directory
 from occystrap import output_mounts
 from occystrap import output_ocibundle
 from occystrap import output_tarfile
+from occystrap import util
 
 
 LOG = logs.setup_console(__name__)
@@ -20,8 +21,16 @@ LOG = logs.setup_console(__name__)
 @click.option('--os', default='linux')
 @click.option('--architecture', default='amd64')
 @click.option('--variant', default='')
+@click.option('--max-concurrent-downloads', default=3,
+              type=click.IntRange(1, util.MAX_CONCURRENT_DOWNLOADS),
+              help='How many layers to download at once.')
+@click.option('--parallel-ranges', default=1,
+              type=click.IntRange(1, util.MAX_PARALLEL_RANGES),
+              help='Split large layers into this many range requests, '
+                   'fetched in parallel.')
 @click.pass_context
-def cli(ctx, verbose=None, os=None, architecture=None, variant=None):
+def cli(ctx, verbose=None, os=None, architecture=None, variant=None,
+        max_concurrent_downloads=None, parallel_ranges=None):
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
         LOG.setLevel(logging.DEBUG)
@@ -31,6 +40,8 @@ def cli(ctx, verbose=None, os=None, architecture=None, variant=None):
     ctx.obj['OS'] = os
     ctx.obj['ARCHITECTURE'] = architecture
     ctx.obj['VARIANT'] = variant
+    ctx.obj['MAX_CONCURRENT_DOWNLOADS'] = max_concurrent_downloads
+    ctx.obj['PARALLEL_RANGES'] = parallel_ranges
 
 
 def _fetch(img, output):
@@ -54,7 +65,9 @@ def fetch_to_extracted(ctx, registry, image, tag, path, use_unique_names,
         image, tag, path, unique_names=use_unique_names, expand=expand)
     img = img = docker_registry.Image(
         registry, image, tag, ctx.obj['OS'], ctx.obj['ARCHITECTURE'],
-        ctx.obj['VARIANT'], secure=(not insecure))
+        ctx.obj['VARIANT'], secure=(not insecure),
+        max_concurrent_downloads=ctx.obj['MAX_CONCURRENT_DOWNLOADS'],
+        max_parallel_ranges=ctx.obj['PARALLEL_RANGES'])
     _fetch(img, d)
 
     if expand:
@@ -75,7 +88,9 @@ def fetch_to_oci(ctx, registry, image, tag, path, insecure):
     d = output_ocibundle.OCIBundleWriter(image, tag, path)
     img = img = docker_registry.Image(
         registry, image, tag, ctx.obj['OS'], ctx.obj['ARCHITECTURE'],
-        ctx.obj['VARIANT'], secure=(not insecure))
+        ctx.obj['VARIANT'], secure=(not insecure),
+        max_concurrent_downloads=ctx.obj['MAX_CONCURRENT_DOWNLOADS'],
+        max_parallel_ranges=ctx.obj['PARALLEL_RANGES'])
     _fetch(img, d)
     d.write_bundle()
 
@@ -94,7 +109,9 @@ def fetch_to_tarfile(ctx, registry, image, tag, tarfile, insecure):
     tar = output_tarfile.TarWriter(image, tag, tarfile)
     img = img = docker_registry.Image(
         registry, image, tag, ctx.obj['OS'], ctx.obj['ARCHITECTURE'],
-        ctx.obj['VARIANT'], secure=(not insecure))
+        ctx.obj['VARIANT'], secure=(not insecure),
+        max_concurrent_downloads=ctx.obj['MAX_CONCURRENT_DOWNLOADS'],
+        max_parallel_ranges=ctx.obj['PARALLEL_RANGES'])
     _fetch(img, tar)
 
 
@@ -119,7 +136,9 @@ def fetch_to_mounts(ctx, registry, image, tag, path, insecure):
     d = output_mounts.MountWriter(image, tag, path)
     img = img = docker_registry.Image(
         registry, image, tag, ctx.obj['OS'], ctx.obj['ARCHITECTURE'],
-        ctx.obj['VARIANT'], secure=(not insecure))
+        ctx.obj['VARIANT'], secure=(not insecure),
+        max_concurrent_downloads=ctx.obj['MAX_CONCURRENT_DOWNLOADS'],
+        max_parallel_ranges=ctx.obj['PARALLEL_RANGES'])
     _fetch(img, d)
     d.write_bundle()
 
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+import shutil
 import tarfile
 
 from occystrap import constants
@@ -94,6 +95,15 @@ TARFILE_TYPE_MAP = {
 }
 
 
+def _members_by_name(layer):
+    # If a name appears more than once in a layer the last entry wins, which
+    # matches the behaviour of TarFile.getmember().
+    members = {}
+    for mem in layer.getmembers():
+        members[mem.name] = mem
+    return members
+
+
 class DirWriter(object):
     def __init__(self, image, tag, image_path, unique_names=False, expand=False):
         self.image = image
@@ -155,10 +165,8 @@ class DirWriter(object):
                 LOG.info('Skipping layer already in output directory')
             else:
                 with open(layer_file_in_dir, 'wb') as f:
-                    d = data.read(102400)
-                    while d:
-                        f.write(d)
-                        d = data.read(102400)
+                    shutil.copyfileobj(data, f,
+                                       constants.TAR_COPY_BUFFER_SIZE)
 
             if self.expand:
                 # Build a in-memory map of the layout of the final image bundle
@@ -239,10 +247,11 @@ class DirWriter(object):
 
     def _extract_rootfs(self, rootfs_path):
         # Reading tarfiles is expensive, as tarfile needs to scan the
-        # entire file to find the right entry. It builds a cache while
-        # doing this however, so performance improves if you access a
-        # bunch of files from the same archive. We therefore group
-        # entities by layer to improve performance.
+        # entire file to find the right entry. We therefore group entities
+        # by layer so that each layer is only scanned once, and then look
+        # up members by name in a dictionary. Passing names to extract()
+        # would instead do a linear search of the member list for each
+        # entity.
         entities_by_layer = {}
 
         # We defer changing the permissions of directories until later
@@ -265,14 +274,18 @@ class DirWriter(object):
             entities_by_layer[ent.tarpath].append(ent)
 
         for tarpath in entities_by_layer:
-            with tarfile.open(os.path.join(self.image_path, tarpath)) as layer:
+            with tarfile.open(os.path.join(self.image_path, tarpath),
+                              copybufsize=constants.TAR_COPY_BUFFER_SIZE) as layer:
+                members = _members_by_name(layer)
                 for ent in entities_by_layer[tarpath]:
-                    layer.extract(ent.name, path=rootfs_path)
+                    layer.extract(members[ent.name], path=rootfs_path)
 
         for tarpath in deferred_by_layer:
-            with tarfile.open(os.path.join(self.image_path, tarpath)) as layer:
+            with tarfile.open(os.path.join(self.image_path, tarpath),
+                              copybufsize=constants.TAR_COPY_BUFFER_SIZE) as layer:
+                members = _members_by_name(layer)
                 for ent in deferred_by_layer[tarpath]:
-                    layer.extract(ent.name, path=rootfs_path)
+                    layer.extract(members[ent.name], path=rootfs_path)
 
     def write_bundle(self):
         manifest_filename = self._manifest_filename()
@@ -314,5 +327,6 @@ class DirReader(object):
             yield (constants.CONFIG_FILE, config_filename, f)
 
         for layer in manifest[0]['Layers']:
-            with open(os.path.join(self.path, layer), 'rb') as f:
+            with open(os.path.join(self.path, layer), 'rb',
+                      buffering=constants.LAYER_READ_BUFFER_SIZE) as f:
                 yield (constants.IMAGE_LAYER, layer, f)
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+import shutil
 import stat
 import tarfile
 
@@ -57,14 +58,13 @@ class MountWriter(object):
                 LOG.info('Skipping layer already in output directory')
             else:
                 with open(layer_file_in_dir, 'wb') as f:
-                    d = data.read(102400)
-                    while d:
-                        f.write(d)
-                        d = data.read(102400)
+                    shutil.copyfileobj(data, f,
+                                       constants.TAR_COPY_BUFFER_SIZE)
 
                 layer_dir_in_dir = os.path.join(self.image_path, name, 'layer')
                 os.makedirs(layer_dir_in_dir)
-                with tarfile.open(layer_file_in_dir) as layer:
+                with tarfile.open(layer_file_in_dir,
+                                  copybufsize=constants.TAR_COPY_BUFFER_SIZE) as layer:
                     for mem in layer.getmembers():
                         dirname, filename = os.path.split(mem.name)
 
@@ -85,8 +85,7 @@ class MountWriter(object):
                                      mode=stat.S_IFCHR, device=0)
 
                         else:
-                            path = mem.name
-                            layer.extract(path, path=layer_dir_in_dir)
+                            layer.extract(mem, path=layer_dir_in_dir)
 
     def finalize(self):
         manifest_filename = self._manifest_filename() + '.json'
@@ -20,7 +20,13 @@ class TarWriter(object):
         self.image = image
         self.tag = tag
         self.image_path = image_path
-        self.image_tar = tarfile.open(image_path, 'w')
+
+        # We only ever append to the output tarball, so write it as a stream.
+        # The stream buffer is sized to match the member copy buffer so that
+        # each chunk of layer data becomes a single write to disk.
+        self.image_tar = tarfile.open(
+            image_path, 'w|', bufsize=constants.TAR_COPY_BUFFER_SIZE,
+            copybufsize=constants.TAR_COPY_BUFFER_SIZE)
 
         self.tar_manifest = [{
             'Layers': [],
@@ -35,7 +41,8 @@ class TarWriter(object):
             LOG.info('Writing config file to tarball')
 
             ti = tarfile.TarInfo(name)
-            ti.size = len(data.read())
+            data.seek(0, os.SEEK_END)
+            ti.size = data.tell()
             data.seek(0)
             self.image_tar.addfile(ti, data)
             self.tar_manifest[0]['Config'] = name
@@ -57,3 +64,4 @@ class TarWriter(object):
         ti = tarfile.TarInfo('manifest.json')
         ti.size = len(encoded_manifest)
         self.image_tar.addfile(ti, io.BytesIO(encoded_manifest))
+        self.image_tar.close()
@@ -0,0 +1,147 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import testtools
+
+
+DOCKER_EXTRACT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'docker_extract.py')
+
+
+def _layer(members):
+    # members is a list of (name, type, data) tuples. data is the content of
+    # a regular file, or the target of a symlink.
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, member_type, data in members:
+            ti = tarfile.TarInfo(name)
+            ti.mtime = 1000
+            if member_type == tarfile.DIRTYPE:
+                ti.type = tarfile.DIRTYPE
+                ti.mode = 0o755
+                tar.addfile(ti)
+            elif member_type == tarfile.SYMTYPE:
+                ti.type = tarfile.SYMTYPE
+                ti.linkname = data
+                tar.addfile(ti)
+            else:
+                ti.size = len(data)
+                ti.mode = 0o644
+                tar.addfile(ti, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _add_bytes(tar, name, data):
+    ti = tarfile.TarInfo(name)
+    ti.size = len(data)
+    tar.addfile(ti, io.BytesIO(data))
+
+
+class DockerExtractTestCase(testtools.TestCase):
+    def setUp(self):
+        super(DockerExtractTestCase, self).setUp()
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.tempdir = tempdir.name
+        self.extracted = os.path.join(self.tempdir, 'extracted')
+        os.makedirs(self.extracted)
+
+        # Something outside the extraction directory for malicious layers
+        # to aim at.
+        self.victim = os.path.join(self.tempdir, 'victim')
+        os.makedirs(os.path.join(self.victim, 'directory'))
+        for name in ['file', 'passwd', 'directory/file']:
+            with open(os.path.join(self.victim, name), 'w') as f:
+                f.write('victim')
+
+    def _extract(self, layers):
+        image_path = os.path.join(self.tempdir, 'image.tar')
+        layer_names = []
+        with tarfile.open(image_path, 'w') as image:
+            for i, layer in enumerate(layers):
+                layer_names.append('%d/layer.tar' % i)
+                _add_bytes(image, layer_names[-1], _layer(layer))
+            _add_bytes(image, 'config.json', b'{}')
+            _add_bytes(image, 'manifest.json', json.dumps(
+                [{'Config': 'config.json', 'Layers': layer_names}]).encode())
+
+        subprocess.run([sys.executable, DOCKER_EXTRACT, image_path,
+                        self.extracted],
+                       check=True, stdout=subprocess.DEVNULL)
+
+    def _exists(self, path):
+        return os.path.lexists(os.path.join(self.extracted, path))
+
+    def _victim_intact(self):
+        for name in ['file', 'passwd', 'directory/file']:
+            with open(os.path.join(self.victim, name)) as f:
+                self.assertEqual('victim', f.read())
+        self.assertEqual(['directory', 'file', 'passwd'],
+                         sorted(os.listdir(self.victim)))
+
+    def test_whiteout_file(self):
+        self._extract([
+            [('file', tarfile.REGTYPE, b'lower'),
+             ('anotherfile', tarfile.REGTYPE, b'lower'),
+             ('directory', tarfile.DIRTYPE, None),
+             ('directory/file', tarfile.REGTYPE, b'lower')],
+            [('.wh.file', tarfile.REGTYPE, b''),
+             ('.wh.directory', tarfile.REGTYPE, b'')]
+        ])
+
+        self.assertFalse(self._exists('file'))
+        self.assertFalse(self._exists('.wh.file'))
+        self.assertFalse(self._exists('directory'))
+        self.assertFalse(self._exists('.wh.directory'))
+        self.assertTrue(self._exists('anotherfile'))
+
+    def test_opaque_whiteout_keeps_same_layer_entries(self):
+        self._extract([
+            [('directory', tarfile.DIRTYPE, None),
+             ('directory/lower', tarfile.REGTYPE, b'lower'),
+             ('directory/subdirectory', tarfile.DIRTYPE, None),
+             ('directory/subdirectory/lower', tarfile.REGTYPE, b'lower'),
+             ('otherdirectory', tarfile.DIRTYPE, None),
+             ('otherdirectory/lower', tarfile.REGTYPE, b'lower')],
+            [('directory', tarfile.DIRTYPE, None),
+             ('directory/subdirectory', tarfile.DIRTYPE, None),
+             ('directory/subdirectory/upper', tarfile.REGTYPE, b'upper'),
+             ('directory/.wh..wh..opq', tarfile.REGTYPE, b''),
+             ('directory/upper', tarfile.REGTYPE, b'upper')]
+        ])
+
+        self.assertFalse(self._exists('directory/lower'))
+        self.assertFalse(self._exists('directory/subdirectory/lower'))
+        self.assertFalse(self._exists('directory/.wh..wh..opq'))
+        self.assertTrue(self._exists('directory/subdirectory/upper'))
+        self.assertTrue(self._exists('directory/upper'))
+        self.assertTrue(self._exists('otherdirectory/lower'))
+
+    def test_whiteout_outside_extraction_directory(self):
+        self._extract([
+            [('file', tarfile.REGTYPE, b'lower')],
+            [('../victim/.wh.file', tarfile.REGTYPE, b''),
+             ('../victim/.wh..wh..opq', tarfile.REGTYPE, b''),
+             ('.wh..', tarfile.REGTYPE, b''),
+             ('.wh.', tarfile.REGTYPE, b'')]
+        ])
+
+        self._victim_intact()
+        self.assertTrue(os.path.isdir(self.extracted))
+        self.assertTrue(self._exists('file'))
+
+    def test_whiteout_through_symlinked_parent(self):
+        self._extract([
+            [('etc', tarfile.SYMTYPE, self.victim)],
+            [('etc/.wh.passwd', tarfile.REGTYPE, b''),
+             ('etc/directory/.wh..wh..opq', tarfile.REGTYPE, b''),
+             ('etc/.wh..wh..opq', tarfile.REGTYPE, b'')]
+        ])
+
+        self._victim_intact()
+        self.assertTrue(os.path.islink(os.path.join(self.extracted, 'etc')))
@@ -0,0 +1,221 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import testtools
+from unittest import mock
+
+
+from occystrap import constants
+from occystrap import docker_registry
+from occystrap import util
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content, headers=None, delay=0):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.delay = delay
+        self.closed = False
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            if self.closed:
+                return
+            time.sleep(self.delay)
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRegistry(object):
+    # Stands in for util.request_url(), serving a single image built from a
+    # list of layer contents.
+    def __init__(self, layers):
+        self.blobs = {}
+        self.slow = set()
+        self.failing = set()
+        self.ranges = True
+        self.responses = []
+        self.requests = []
+        self.lock = threading.Lock()
+
+        config = json.dumps({'config': {}}).encode()
+        self.manifest = {
+            'schemaVersion': 2,
+            'config': {'digest': self._add_blob(config),
+                       'size': len(config)},
+            'layers': []
+        }
+        for layer in layers:
+            # A fixed timestamp keeps identical layers identical once
+            # compressed, as they are in real images.
+            blob = gzip.compress(layer, mtime=0)
+            self.manifest['layers'].append(
+                {'digest': self._add_blob(blob), 'size': len(blob)})
+
+    def _add_blob(self, blob):
+        digest = 'sha256:%s' % hashlib.sha256(blob).hexdigest()
+        self.blobs[digest] = blob
+        return digest
+
+    def layer_digest(self, index):
+        return self.manifest['layers'][index]['digest']
+
+    def blob_requests(self, digest):
+        return [r for r in self.requests if r[0] == digest]
+
+    def request_url(self, method, url, headers=None, data=None, stream=False):
+        if '/manifests/' in url:
+            return FakeResponse(
+                200, json.dumps(self.manifest).encode(),
+                headers={'Content-Type': ('application/vnd.docker.'
+                                          'distribution.manifest.v2+json')})
+
+        digest = url.split('/blobs/')[1]
+        with self.lock:
+            self.requests.append((digest, (headers or {}).get('Range')))
+
+        if digest in self.failing:
+            raise util.APIException('API request failed', method, url, 500)
+
+        delay = 0
+        if digest in self.slow:
+            delay = 0.01
+
+        blob_range = (headers or {}).get('Range')
+        if blob_range and self.ranges:
+            start, end = blob_range.split('=')[1].split('-')
+            r = FakeResponse(206, self.blobs[digest][int(start):int(end) + 1],
+                             delay=delay)
+        else:
+            r = FakeResponse(200, self.blobs[digest], delay=delay)
+        if stream:
+            with self.lock:
+                self.responses.append(r)
+        return r
+
+
+class DockerRegistryTestCase(testtools.TestCase):
+    def _image(self, registry, **kwargs):
+        patcher = mock.patch('occystrap.util.request_url',
+                             side_effect=registry.request_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return docker_registry.Image('localhost:5000', 'image', 'latest',
+                                     secure=False, **kwargs)
+
+    def test_fetch(self):
+        layers = [os.urandom(1024) for _ in range(5)]
+        registry = FakeRegistry(layers)
+        img = self._image(registry)
+
+        elements = list(img.fetch())
+        self.assertEqual(constants.CONFIG_FILE, elements[0][0])
+        self.assertEqual(len(layers), len(elements) - 1)
+        for i in range(len(layers)):
+            element_type, name, _ = elements[i + 1]
+            self.assertEqual(constants.IMAGE_LAYER, element_type)
+            self.assertEqual(registry.layer_digest(i).split(':')[1], name)
+
+    def test_fetch_window(self):
+        layers = [os.urandom(1024) for _ in range(10)]
+        registry = FakeRegistry(layers)
+        img = self._image(registry, max_concurrent_downloads=2)
+        window = 2 + docker_registry.DOWNLOAD_LOOKAHEAD
+
+        yielded = 0
+        for element_type, name, data in img.fetch():
+            if element_type != constants.IMAGE_LAYER:
+                continue
+
+            # Downloads are only started once earlier layers have been
+            # handed over, so we never get more than a window ahead.
+            self.assertEqual(layers[yielded], data.read())
+            yielded += 1
+            self.assertLessEqual(len(registry.requests) - 1,
+                                 yielded - 1 + window)
+
+        self.assertEqual(len(layers), yielded)
+
+    def test_fetch_duplicate_layers(self):
+        layers = [os.urandom(1024), b'', os.urandom(1024), b'', b'']
+        registry = FakeRegistry(layers)
+        img = self._image(registry, max_concurrent_downloads=1)
+
+        seen = []
+        for element_type, name, data in img.fetch():
+            if element_type == constants.IMAGE_LAYER:
+                seen.append((name, data.read()))
+
+        # Every reference is yielded with the right contents, but each
+        # unique blob is only downloaded once.
+        self.assertEqual(
+            [(registry.layer_digest(i).split(':')[1], layer)
+             for i, layer in enumerate(layers)],
+            seen)
+        for i in range(len(layers)):
+            self.assertEqual(
+                1, len(registry.blob_requests(registry.layer_digest(i))))
+
+    def _fetch_ranges(self, registry):
+        with mock.patch.object(docker_registry, 'RANGE_FETCH_THRESHOLD',
+                               32 * 1024):
+            img = self._image(registry, max_parallel_ranges=3)
+            return [data.read() for element_type, _, data in img.fetch()
+                    if element_type == constants.IMAGE_LAYER]
+
+    def test_fetch_ranges(self):
+        layers = [os.urandom(1024), os.urandom(64 * 1024)]
+        registry = FakeRegistry(layers)
+
+        self.assertEqual(layers, self._fetch_ranges(registry))
+
+        # Only the layer above the threshold is split into ranges, and
+        # those cover the whole blob.
+        self.assertEqual([None], [r[1] for r in registry.blob_requests(
+            registry.layer_digest(0))])
+        size = registry.manifest['layers'][1]['size']
+        range_size = -(-size // 3)
+        self.assertEqual(
+            sorted('bytes=%d-%d' % (start, min(start + range_size, size) - 1)
+                   for start in range(0, size, range_size)),
+            sorted(r[1] for r in registry.blob_requests(
+                registry.layer_digest(1))))
+
+    def test_fetch_ranges_unsupported(self):
+        layers = [os.urandom(64 * 1024)]
+        registry = FakeRegistry(layers)
+        registry.ranges = False
+
+        # A registry which ignores the Range header gets a single request
+        # for the whole blob instead.
+        self.assertEqual(layers, self._fetch_ranges(registry))
+        requests = registry.blob_requests(registry.layer_digest(0))
+        self.assertEqual(None, requests[-1][1])
+        self.assertEqual(1, len([r for r in requests if not r[1]]))
+
+    def test_fetch_failure_stops_downloads(self):
+        layers = [os.urandom(1024 * 1024) for _ in range(3)]
+        registry = FakeRegistry(layers)
+        registry.failing.add(registry.layer_digest(0))
+        registry.slow.add(registry.layer_digest(1))
+        registry.slow.add(registry.layer_digest(2))
+
+        # Each slow layer takes about ten seconds if it is read to the end,
+        # as its response hands out 1 KiB chunks with a pause before each.
+        with mock.patch.object(docker_registry, 'DOWNLOAD_CHUNK_SIZE', 1024):
+            img = self._image(registry)
+            start = time.time()
+            self.assertRaises(util.APIException, list, img.fetch())
+
+        self.assertLess(time.time() - start, 5)
+        for r in registry.responses:
+            self.assertTrue(r.closed)
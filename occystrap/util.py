@@ -3,6 +3,7 @@ import logging
 from oslo_concurrency import processutils
 from pbr.version import VersionInfo
 import requests
+from requests.adapters import HTTPAdapter
 
 
 LOG = logging.getLogger(__name__)
@@ -21,6 +22,24 @@ STATUS_CODES_TO_ERRORS = {
 }
 
 
+# docker_registry downloads at most this many layers at once, and splits
+# each of them into at most this many range requests.
+MAX_CONCURRENT_DOWNLOADS = 8
+MAX_PARALLEL_RANGES = 4
+
+# All requests share a single session so that connections (and TLS sessions)
+# to a registry are reused between the manifest, config and layer requests,
+# instead of requests.request() building a new pool for every call. The pool
+# has room for every range of every concurrent layer download, plus the
+# config request made while they run.
+CONNECTION_POOL_SIZE = MAX_CONCURRENT_DOWNLOADS * MAX_PARALLEL_RANGES + 1
+
+SESSION = requests.Session()
+for prefix in ['http://', 'https://']:
+    SESSION.mount(prefix, HTTPAdapter(pool_connections=CONNECTION_POOL_SIZE,
+                                      pool_maxsize=CONNECTION_POOL_SIZE))
+
+
 def get_user_agent():
     try:
         version = VersionInfo('occystrap').version_string()
@@ -33,12 +52,14 @@ def request_url(method, url, headers=None, data=None, stream=False):
     if not headers:
         headers = {}
     headers.update({'User-Agent': get_user_agent()})
+    body = None
     if data:
         headers['Content-Type'] = 'application/json'
-    r = requests.request(method, url,
-                         data=json.dumps(data),
-                         headers=headers,
-                         stream=stream)
+        body = json.dumps(data)
+    r = SESSION.request(method, url,
+                        data=body,
+                        headers=headers,
+                        stream=stream)
 
     LOG.debug('-------------------------------------------------------')
     LOG.debug('API client requested: %s %s (stream=%s)'
@@ -71,7 +92,7 @@ def request_url(method, url, headers=None, data=None, stream=False):
         raise STATUS_CODES_TO_ERRORS[r.status_code](
             'API request failed', method, url, r.status_code, r.text, r.headers)
 
-    if r.status_code != 200:
+    if r.status_code not in (200, 206):
         raise APIException(
             'API request failed', method, url, r.status_code, r.text, r.headers)
     return r